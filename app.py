@@ -1,26 +1,53 @@
 import os
 import io
+import copy
 import zipfile
 import logging
+import math
 import sqlite3
+import queue
+import tempfile
+import time
+import functools
+import hashlib
+import itertools
+import collections
+import uuid
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from types import MappingProxyType
 from flask import Flask, render_template, request, redirect, url_for, send_file, flash, g, session, jsonify
-from PIL import Image
-import ezdxf
-import pandas as pd
+from flask.json.provider import DefaultJSONProvider
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from io import StringIO, BytesIO
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import re
 from werkzeug.routing import BuildError
+from jinja2 import FileSystemBytecodeCache
 
-# optional HEIC support
+# optional orjson support (高速 JSON エンコーダ)
 try:
-    import pillow_heif
-    pillow_heif.register_heif_opener()
-    HEIF_AVAILABLE = True
+    import orjson
+    ORJSON_AVAILABLE = True
 except Exception:
-    HEIF_AVAILABLE = False
+    ORJSON_AVAILABLE = False
+
+# optional MessagePack support (セッション Cookie のシリアライズ用)
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except Exception:
+    MSGPACK_AVAILABLE = False
+
+# optional pyahocorasick support (禁止語の多パターン照合用)
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except Exception:
+    AHOCORASICK_AVAILABLE = False
 
 # ログを抑制
 log = logging.getLogger('werkzeug')
@@ -28,23 +55,185 @@ log.setLevel(logging.ERROR)
 
 # --- 定数定義 ---
 MAX_TAGS = 5
+FORUM_PAGE_SIZE = 50
+# OFFSET は SQLite の 64 bit 整数に収まる必要があるので、ページ番号はここで頭打ちにする
+FORUM_MAX_PAGE = (2 ** 63 - 1) // FORUM_PAGE_SIZE
 FORBIDDEN_WORDS = ['spam', 'test']
+# 禁止語は 1 つの正規表現にまとめ、語数に関係なく 1 回の走査で判定する
+# 部分一致だと "latest" や "contest" まで弾くので、単語として現れた場合だけ一致させる
+FORBIDDEN_RE = re.compile(r'\b(?:%s)\b' % '|'.join(map(re.escape, FORBIDDEN_WORDS)), re.IGNORECASE)
 MAX_ARTICLE_LENGTH = 5000
 MAX_COMMENT_LENGTH = 1000
 
+def build_forbidden_automaton(words):
+    """禁止語の Aho-Corasick オートマトンを作る（pyahocorasick が無ければ None）"""
+    if not AHOCORASICK_AVAILABLE or not words:
+        return None
+    automaton = ahocorasick.Automaton()
+    for word in words:
+        automaton.add_word(word.lower(), word)
+    automaton.make_automaton()
+    return automaton
+
+FORBIDDEN_AC = build_forbidden_automaton(FORBIDDEN_WORDS)
+
+def _is_word_char(text, i):
+    return 0 <= i < len(text) and (text[i].isalnum() or text[i] == '_')
+
+def contains_forbidden(text):
+    """text に禁止語が単語として含まれるか（大文字小文字は区別しない）
+
+    オートマトンがあれば辞書の大きさに関係なく文字列長に比例する 1 回の走査で判定し、
+    無い環境では FORBIDDEN_RE で同じ判定をする。どちらも前後が英数字の一致は数えない。
+    """
+    if FORBIDDEN_AC is not None:
+        lowered = text.lower()
+        for end, word in FORBIDDEN_AC.iter(lowered):
+            start = end - len(word) + 1
+            if not _is_word_char(lowered, start - 1) and not _is_word_char(lowered, end + 1):
+                return True
+        return False
+    return FORBIDDEN_RE.search(text) is not None
+
 def check_spam_content(body, max_len):
     """プレースホルダーのスパムチェック関数"""
     if len(body) > max_len:
         return True, f"本文が長すぎます (最大 {max_len} 文字)"
+    if contains_forbidden(body):
+        return True, "不適切な語句が含まれています"
     return False, ""
 
+class OrjsonProvider(DefaultJSONProvider):
+    """orjson を使う JSON プロバイダ（jsonify とセッション Cookie のエンコードに使われる）
+
+    datetime などは Flask 既定の default() に渡し、出力形式を標準プロバイダと揃える。
+    """
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class MsgpackSerializer:
+    """itsdangerous に渡すバイナリシリアライザ（タグ付き JSON より小さく速い）"""
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+class _TextURLSafeTimedSerializer(URLSafeTimedSerializer):
+    """バイナリシリアライザでも Cookie に載せられるよう、署名済みトークンを str で返す"""
+
+    def dumps(self, obj, salt=None):
+        return super().dumps(obj, salt).decode('ascii')
+
+class MsgpackSessionInterface(SecureCookieSessionInterface):
+    """署名付き Cookie セッションの中身を MessagePack で保存する
+
+    salt を変えて旧形式と区別する。MessagePack として検証できない Cookie は Flask 標準の
+    タグ付き JSON（旧 salt）として読み直し、読めた場合は次の応答で MessagePack に書き換える。
+    """
+    salt = 'cookie-session-msgpack'
+    serializer = MsgpackSerializer()
+    legacy_interface = SecureCookieSessionInterface()
+
+    def open_session(self, app, request):
+        s = self.get_signing_serializer(app)
+        if s is None:
+            return None
+        val = request.cookies.get(self.get_cookie_name(app))
+        if not val:
+            return self.session_class()
+        max_age = int(app.permanent_session_lifetime.total_seconds())
+        try:
+            return self.session_class(s.loads(val, max_age=max_age))
+        except BadSignature:
+            pass
+        try:
+            data = self.legacy_interface.get_signing_serializer(app).loads(val, max_age=max_age)
+        except BadSignature:
+            return self.session_class()
+        session = self.session_class(data)
+        session.modified = True
+        return session
+
+    def get_signing_serializer(self, app):
+        if not app.secret_key:
+            return None
+        keys = list(app.config.get('SECRET_KEY_FALLBACKS') or [])
+        keys.append(app.secret_key)
+        return _TextURLSafeTimedSerializer(
+            keys,
+            salt=self.salt,
+            serializer=self.serializer,
+            signer_kwargs={
+                'key_derivation': self.key_derivation,
+                'digest_method': self.digest_method,
+            },
+        )
+
 # --- アプリ設定 ---
 app = Flask(__name__)
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
 app.secret_key = os.environ.get('FLASK_SECRET', 'your_super_secret_key_z_system_proto_0')
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+# アップロード全体の上限（HEIC の一括変換を想定して既定 500MB）
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 500 * 1024 * 1024))
+
+if MSGPACK_AVAILABLE:
+    app.session_interface = MsgpackSessionInterface()
+
+# サーバーサイドセッション（SESSION_REDIS_URL 指定時のみ）
+# 日次記録リストが伸びても Cookie にはセッション ID だけが載る
+session_redis_url = os.environ.get('SESSION_REDIS_URL')
+if session_redis_url:
+    try:
+        import redis
+        from flask_session import Session
+        app.config['SESSION_TYPE'] = 'redis'
+        app.config['SESSION_REDIS'] = redis.from_url(session_redis_url)
+        # Redis 上の値も JSON ではなく MessagePack で保存する
+        app.config['SESSION_SERIALIZATION_FORMAT'] = 'msgpack'
+        Session(app)
+    except Exception:
+        logging.getLogger(__name__).warning('Redis セッションを初期化できませんでした。Cookie セッションを使用します。')
+
+# HTML / JSON の応答圧縮（Flask-Compress がある場合のみ。Vary: Accept-Encoding も付く）
+# Zip や JPEG は COMPRESS_MIMETYPES に含まれないので、圧縮済みのデータを再圧縮しない
+try:
+    from flask_compress import Compress
+    app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+    app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 4))
+    app.config['COMPRESS_BR_LEVEL'] = int(os.environ.get('COMPRESS_BR_LEVEL', 4))
+    app.config['COMPRESS_MIN_SIZE'] = 1024
+    Compress(app)
+except ImportError:
+    pass
+
+def _freeze_config(value):
+    """設定の dict / list を読み取り専用の MappingProxyType / tuple に変換する
+
+    子メニューを持つナビ項目には子の id の frozenset（child_ids）を付け、
+    テンプレートが描画のたびに子を走査しなくても開閉状態を判定できるようにする。
+    """
+    if isinstance(value, dict):
+        frozen = {k: _freeze_config(v) for k, v in value.items()}
+        if 'children' in frozen:
+            frozen['child_ids'] = frozenset(child['id'] for child in frozen['children'])
+        return MappingProxyType(frozen)
+    if isinstance(value, list):
+        return tuple(_freeze_config(v) for v in value)
+    return value
 
 APP_NAME = 'ITショクチョー！'
-APP_CONFIG = {
+APP_CONFIG = _freeze_config({
     'app_name': APP_NAME,
     'app_title': 'Ζシステムシリーズ：現場の総合アプリ',
     'app_subtitle': '現場に携わる技術者のための',
@@ -64,20 +253,55 @@ APP_CONFIG = {
         'comparison': {'name': '⚖️ 比較見積もり', 'url': 'comparison_tool_page'},
         'forum': {'name': '💬 詰所（掲示板）', 'url': 'forum'},
     }
-}
+})
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'data.db')
 
+# リクエスト間で使い回す SQLite 接続のプール（毎回の connect/close を避ける）
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+# 接続ごとのプリペアドステートメントのキャッシュ数（SQL 文字列が一致すれば再パースしない）
+DB_CACHED_STATEMENTS = 256
+
+# よく使う書き込み SQL。同じ文字列を使い回してステートメントキャッシュに確実に当てる
+SQL_INSERT_ARTICLE = "INSERT INTO articles (title, body, tags, created_at) VALUES (?, ?, ?, ?)"
+SQL_INSERT_ARTICLE_TAG = "INSERT OR IGNORE INTO article_tags (article_id, tag) VALUES (?, ?)"
+SQL_INSERT_COMMENT = "INSERT INTO comments (article_id, body, created_at) VALUES (?, ?, ?)"
+SQL_INSERT_DAILY_RECORD = "INSERT INTO daily_records (kind, session_id, payload, created_at) VALUES (?, ?, ?, ?)"
+
+@functools.lru_cache(maxsize=64)
+def _row_class(description):
+    """列の並び（cursor.description）ごとの行クラス。列名が識別子でなければ _0 などに置き換える"""
+    return collections.namedtuple('Row', [d[0] for d in description], rename=True)
+
+def _namedtuple_row(cursor, row):
+    """行を namedtuple で返す row_factory（テンプレートの a.title が属性参照 1 回で済む）"""
+    return _row_class(cursor.description)._make(row)
+
+def _connect_db():
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+    db.row_factory = _namedtuple_row
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('PRAGMA temp_store=MEMORY')
+    db.execute('PRAGMA mmap_size=268435456')
+    db.execute('PRAGMA cache_size=-20000')
+    return db
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
+        try:
+            db = _db_pool.get_nowait()
+        except queue.Empty:
+            db = _connect_db()
+        g._database = db
     return db
 
 def init_db():
     db = sqlite3.connect(DB_PATH)
     cur = db.cursor()
+    # WAL はデータベースファイルに記録されるので初期化時に一度だけ設定する
+    cur.execute('PRAGMA journal_mode=WAL')
     cur.execute('''
     CREATE TABLE IF NOT EXISTS articles (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -96,9 +320,65 @@ def init_db():
         FOREIGN KEY(article_id) REFERENCES articles(id) ON DELETE CASCADE
     )
     ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_articles_created ON articles(created_at DESC)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_comments_article_created ON comments(article_id, created_at)')
+    # 歩掛マスターの日次記録（Cookie に載せず、セッション ID ごとに保存する）
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS daily_records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        session_id TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_daily_records_owner ON daily_records(kind, session_id, id DESC)')
+    init_article_tags(cur)
+    init_forum_version(cur)
     db.commit()
     db.close()
 
+def split_tags(tags_str):
+    """カンマ区切りのタグ文字列を、小文字化・空要素除去したタグのリストにする"""
+    return [t.strip().lower() for t in (tags_str or '').split(',') if t.strip()]
+
+def init_article_tags(cur):
+    """記事ごとのタグを 1 行ずつ持つ article_tags を作成する
+
+    タグ検索・関連記事は tag の索引を引く等値検索で済ませ、読み出しのたびに
+    tags 列を分割・部分一致させない。新規作成時は既存記事のタグを取り込む。
+    """
+    exists = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'article_tags'").fetchone()
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS article_tags (
+        article_id INTEGER NOT NULL,
+        tag TEXT NOT NULL,
+        PRIMARY KEY(article_id, tag),
+        FOREIGN KEY(article_id) REFERENCES articles(id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_article_tags_tag ON article_tags(tag, article_id)')
+    if not exists:
+        rows = cur.execute("SELECT id, tags FROM articles WHERE tags IS NOT NULL AND tags != ''").fetchall()
+        cur.executemany(SQL_INSERT_ARTICLE_TAG, [(aid, t) for aid, tags in rows for t in split_tags(tags)])
+
+FORUM_VERSIONED_TABLES = ('articles', 'comments', 'article_tags')
+
+def init_forum_version(cur):
+    """掲示板の変更カウンタ forum_version を作成する
+
+    記事・コメント・タグの追加・更新・削除のたびにトリガーで 1 増やす。アプリ外での
+    編集や削除でも変わるので、掲示板ページのキャッシュのバージョンに使える。
+    """
+    cur.execute('CREATE TABLE IF NOT EXISTS forum_version (id INTEGER PRIMARY KEY CHECK (id = 1), counter INTEGER NOT NULL)')
+    cur.execute('INSERT OR IGNORE INTO forum_version (id, counter) VALUES (1, 0)')
+    for table in FORUM_VERSIONED_TABLES:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cur.execute(
+                f'CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} '
+                'BEGIN UPDATE forum_version SET counter = counter + 1 WHERE id = 1; END'
+            )
+
 try:
     init_db()
 except Exception:
@@ -106,11 +386,38 @@ except Exception:
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
+    db = g.pop('_database', None)
+    if db is None:
+        return
+    # 未確定のトランザクションを残したままプールへ戻さない
+    if db.in_transaction:
+        db.rollback()
+    try:
+        _db_pool.put_nowait(db)
+    except queue.Full:
         db.close()
 
-app.jinja_env.globals.update(zip=zip, enumerate=enumerate, len=len, now=datetime.now)
+@functools.lru_cache(maxsize=1)
+def _datetime_at(second):
+    return datetime.fromtimestamp(second)
+
+def template_now():
+    """テンプレート用の現在時刻。同じ 1 秒内の描画では同じ datetime を共有する"""
+    return _datetime_at(int(time.time()))
+
+def cycle_pairs(steps, checks):
+    """作業サイクルのステップとチェックを組にする（長さが違っても切り捨てず、足りない側は空欄）"""
+    return itertools.zip_longest(steps or (), checks or (), fillvalue='')
+
+app.jinja_env.globals.update(cycle_pairs=cycle_pairs, now=template_now)
+
+# コンパイル済みテンプレートをファイルにキャッシュし、ワーカー起動後の初回描画で再パースしない
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dokenapp_jinja_cache'))
+try:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+except OSError:
+    logging.getLogger(__name__).warning('Jinja のバイトコードキャッシュを有効化できませんでした。')
 
 # ===== 歩掛マスター共通関数 =====
 MASTER_DATA = {
@@ -138,59 +445,363 @@ MASTER_DATA = {
     'personnel_unit_cost_per_hour': 6000,
 }
 
+# プロトタイプ版の現場データ既定値
+_DEFAULT_PROTO_PROJECT = {
+    'site_name': '未設定の現場',
+    'task_name': '未設定の作業',
+    'planned_quantity': 0.0,
+    'planned_unit': '',
+    'cycle_steps': [],
+    'cycle_checks': [],
+    'budget': {'labor': 0, 'machine': 0, 'materials': 0},
+    'design_link': '',
+    'phase': '施工前',
+    'progress_pct': 0.0,
+    'actual_cost': 0.0,
+}
+
+# 機械名 → 時間単価（calculate_daily_cost の検索用）
+_MACHINE_COST_BY_NAME = {m['name']: m['unit_cost_per_hour'] for m in MASTER_DATA['machines']}
+
 def safe_float(value, default=0.0):
+    # 未入力欄や 'inf' / 'nan' は例外を発生させずに既定値を返す
+    if value is None or value == '':
+        return default
     try:
-        return float(value)
+        result = float(value)
     except (TypeError, ValueError):
         return default
+    return result if math.isfinite(result) else default
 
 def calculate_daily_cost(personnel_count, work_time, machinery_list):
     """機械単価と人件費単価から実費を計算"""
     personnel_rate = MASTER_DATA['personnel_unit_cost_per_hour']
     cost_personnel = personnel_count * work_time * personnel_rate
-    cost_machinery = 0
-    for machine_name in machinery_list:
-        machine = next((m for m in MASTER_DATA['machines'] if m['name'] == machine_name), None)
-        if machine:
-            cost_machinery += work_time * machine['unit_cost_per_hour']
+    cost_machinery = work_time * sum(_MACHINE_COST_BY_NAME.get(name, 0) for name in machinery_list)
     return round(cost_personnel, 0), round(cost_machinery, 0), round(cost_personnel + cost_machinery, 0)
 
-def update_project_from_daily(project_data, daily_records, session_key='workmaster_data'):
-    """日次記録からプロジェクト進捗を更新"""
-    cumulative_qty = sum(rec.get('progress_value_float', 0.0) for rec in daily_records)
-    planned_qty = project_data.get('planned_quantity') or (daily_records[-1].get('progress_total_float') if daily_records else 0.0)
+def build_daily_record(form, planned_quantity, progress_key='progress_pct'):
+    """日次記録フォームから記録 dict を組み立てる（メイン版・プロト版共通）
+
+    progress_key はサイクル進捗率のキー名（プロト版は 'progress'）。
+    """
+    machinery_list = form.getlist('machinery[]')
+    progress_value = safe_float(form.get('progress_value'))
+    progress_total = safe_float(form.get('progress_total'), planned_quantity)
+    personnel = int(safe_float(form.get('personnel'), 0))
+    work_time = safe_float(form.get('work_time'), 0)
+
+    cycle_entries = [
+        {
+            'step': s,
+            'count': int(safe_float(c, 0)) if c else None,
+            progress_key: safe_float(p, None) if p else None,
+        }
+        for s, c, p in zip(form.getlist('cycle_step[]'), form.getlist('cycle_count[]'), form.getlist('cycle_progress[]'))
+        if s
+    ]
+
+    cost_personnel, cost_machinery, cost_total = calculate_daily_cost(personnel, work_time, machinery_list)
+
+    return {
+        'date': form.get('record_date'),
+        'personnel': personnel,
+        'machinery': machinery_list,
+        'work_time': work_time,
+        'work_content': form.getlist('work_content[]'),
+        'progress_unit': form.get('progress_unit'),
+        'progress_value': progress_value,
+        'progress_total': progress_total,
+        'progress_value_float': progress_value,
+        'progress_total_float': progress_total,
+        'cycle_entries': cycle_entries,
+        'weather': form.get('weather'),
+        'remarks': form.get('remarks'),
+        'cost_personnel': cost_personnel,
+        'cost_machinery': cost_machinery,
+        'cost_total': cost_total,
+    }
+
+# 日次記録の種類と、以前セッションに保存していたときのキー
+DAILY_RECORD_KINDS = {
+    'workmaster': 'workmaster_daily_records',
+    'proto': 'proto_daily_records',
+}
+DAILY_RECORDS_DISPLAY_LIMIT = 100
+
+def daily_session_id():
+    """日次記録の持ち主を表すセッション ID（Cookie にはこれだけを載せる）"""
+    sid = session.get('session_id')
+    if not sid:
+        sid = uuid.uuid4().hex
+        session['session_id'] = sid
+    return sid
+
+def _import_session_daily_records(db, kind, sid):
+    """セッションに残っている旧形式の日次記録を DB へ一括で移す"""
+    legacy = session.pop(DAILY_RECORD_KINDS[kind], None)
+    if not legacy:
+        return
+    now = datetime.utcnow().isoformat()
+    db.executemany(
+        SQL_INSERT_DAILY_RECORD,
+        [(kind, sid, app.json.dumps(rec, sort_keys=False), now) for rec in legacy],
+    )
+    db.commit()
+
+def save_daily_record(kind, record):
+    """日次記録を 1 件追加する（Excel の列順が記録のキー順になるので、キーは並べ替えない）"""
+    db = get_db()
+    sid = daily_session_id()
+    _import_session_daily_records(db, kind, sid)
+    db.execute(
+        SQL_INSERT_DAILY_RECORD,
+        (kind, sid, app.json.dumps(record, sort_keys=False), datetime.utcnow().isoformat()),
+    )
+    db.commit()
+
+def load_daily_records(kind, limit=None, newest_first=False):
+    """日次記録を古い順（newest_first=True なら新しい順）で返す。limit を指定すると新しいものから limit 件だけ読む"""
+    db = get_db()
+    sid = daily_session_id()
+    _import_session_daily_records(db, kind, sid)
+    # 全件なら表示順のまま索引をたどらせ、Python 側でリストを反転しない。
+    # 新しいものから limit 件を古い順で返すときだけ読んだ後に反転する
+    descending = newest_first or limit is not None
+    query = "SELECT payload FROM daily_records WHERE kind = ? AND session_id = ? ORDER BY id " + ("DESC" if descending else "ASC")
+    params = (kind, sid)
+    if limit is not None:
+        query += " LIMIT ?"
+        params += (limit,)
+    loads = app.json.loads
+    records = [loads(row[0]) for row in db.execute(query, params)]
+    if descending and not newest_first:
+        records.reverse()
+    return records
+
+def daily_totals(kind):
+    """このセッションの日次記録の累計数量・累計実費と最新の記録を DB から求める
+
+    累計はセッションに持たず、毎回 daily_records を集計する（別タブや古い Cookie でもずれない）。
+    合計は SQLite 側で 1 回の集計クエリで求め、記録を Python に読み込まない。
+    JSON 関数がない SQLite では全件を読み込んで Python で合計する。
+    """
+    db = get_db()
+    sid = daily_session_id()
+    _import_session_daily_records(db, kind, sid)
+    try:
+        cumulative_qty, actual_cost = db.execute(
+            "SELECT TOTAL(json_extract(payload, '$.progress_value_float')), TOTAL(json_extract(payload, '$.cost_total')) "
+            "FROM daily_records WHERE kind = ? AND session_id = ?",
+            (kind, sid),
+        ).fetchone()
+    except sqlite3.OperationalError:
+        records = load_daily_records(kind)
+        cumulative_qty = sum(rec.get('progress_value_float', 0.0) for rec in records)
+        actual_cost = sum(rec.get('cost_total', 0.0) for rec in records)
+        return cumulative_qty, actual_cost, (records[-1] if records else None)
+    last = db.execute(
+        "SELECT payload FROM daily_records WHERE kind = ? AND session_id = ? ORDER BY id DESC LIMIT 1",
+        (kind, sid),
+    ).fetchone()
+    return cumulative_qty, actual_cost, (app.json.loads(last[0]) if last else None)
+
+def project_with_totals(project_data, kind):
+    """表示用に、日次記録の累計から進捗率と工程を加えたプロジェクトの dict を返す（セッションには保存しない）"""
+    cumulative_qty, actual_cost, last_record = daily_totals(kind)
+    planned_qty = project_data.get('planned_quantity') or (last_record.get('progress_total_float') if last_record else 0.0)
     progress_pct = (cumulative_qty / planned_qty * 100) if planned_qty else 0.0
-    project_data['planned_quantity'] = planned_qty
-    project_data['progress_pct'] = round(min(progress_pct, 100.0), 1)
-    project_data['phase'] = '竣工' if project_data['progress_pct'] >= 100 else ('施工中' if cumulative_qty > 0 else '施工前')
-    project_data['actual_cost'] = round(sum(rec.get('cost_total', 0.0) for rec in daily_records), 0)
-    session[session_key] = project_data
+    progress_pct = round(min(progress_pct, 100.0), 1)
+    return {
+        **project_data,
+        'planned_quantity': planned_qty,
+        'progress_pct': progress_pct,
+        'phase': '竣工' if progress_pct >= 100 else ('施工中' if cumulative_qty > 0 else '施工前'),
+        'cumulative_qty': cumulative_qty,
+        'actual_cost': round(actual_cost, 0),
+    }
+
+def _excel_cell(value):
+    """xlsxwriter が直接書けない値（リスト・辞書など）は文字列にする"""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+def _write_record_row(ws, row_idx, values):
+    """日次記録の 1 行を書く。値の型で write_string / write_number を直接選ぶ
+
+    write_row は 1 セルごとに汎用の write() で型を調べ、文字列なら数式・URL かの判定もする。
+    記録の値はほぼ文字列と数値なので直接書き分け、入力文字列は数式にせずそのまま書く。
+    """
+    write_string = ws.write_string
+    write_number = ws.write_number
+    for col, value in enumerate(values):
+        kind = type(value)
+        if kind is str:
+            write_string(row_idx, col, value)
+        elif kind is float or kind is int:
+            write_number(row_idx, col, value)
+        elif value is not None:
+            ws.write(row_idx, col, _excel_cell(value))
+
+def summarize_cycle_steps(cycle_steps):
+    """作業サイクルを Excel の 1 セル用に連結する"""
+    # join はジェネレータを渡してもリスト化するので、f 文字列の生成式ではなく map(str) で渡す
+    return ", ".join(map(str, cycle_steps))
+
+def build_workmaster_excel(daily_records, project_data):
+    """日次記録と現場設定を xlsx に書き出し、先頭に巻き戻した BytesIO を返す"""
+    import xlsxwriter
+    headers = list(dict.fromkeys(k for rec in daily_records for k in rec))
+    machinery_col = headers.index('machinery') if 'machinery' in headers else None
+
+    output = BytesIO()
+    # 行は上から順に書くので constant_memory で各行を書き終えた時点で一時ファイルへ流す
+    # （in_memory を指定すると constant_memory が無効になるため併用しない）
+    wb = xlsxwriter.Workbook(output, {'constant_memory': True})
+
+    # 日次記録シート
+    ws = wb.add_worksheet('日次記録')
+    ws.write_row(0, 0, headers)
+    # 記録ごとの dict のコピーは作らず、行のリストを組み立てるときに重機名だけ連結する
+    for i, rec in enumerate(daily_records, 1):
+        row = [rec.get(k) for k in headers]
+        if machinery_col is not None and isinstance(row[machinery_col], list):
+            row[machinery_col] = ", ".join(row[machinery_col])
+        _write_record_row(ws, i, row)
+
+    # 現場設定シート
+    site_info = {
+        '現場名': project_data.get('site_name', 'N/A'),
+        '作業名': project_data.get('task_name', 'N/A'),
+        '道具': project_data.get('tool_list', 'N/A'),
+        '作業サイクル': project_data.get('_cycle_summary') or summarize_cycle_steps(project_data.get('cycle_steps', ())),
+    }
+    ws_site = wb.add_worksheet('現場設定')
+    ws_site.write_row(0, 0, list(site_info.keys()))
+    ws_site.write_row(1, 0, [_excel_cell(v) for v in site_info.values()])
+
+    wb.close()
+    output.seek(0)
+    return output
+
+# Excel の現場設定シートに使うプロジェクトの項目（キャッシュのキーにもする）
+EXCEL_PROJECT_KEYS = ('site_name', 'task_name', 'tool_list', '_cycle_summary', 'cycle_steps')
+
+@functools.lru_cache(maxsize=32)
+def _cached_workmaster_excel(kind, sid, version, site_json):
+    return build_workmaster_excel(load_daily_records(kind), app.json.loads(site_json)).getvalue()
+
+def workmaster_excel_bytes(kind, project_data):
+    """このセッションの日次記録の xlsx を bytes で返す（記録がなければ None）
+
+    記録は追記しかされないので、最新の記録 ID と現場設定が前回と同じなら
+    作成済みのファイルをそのまま返し、記録の読み込みと書き出しを省く。
+    """
+    db = get_db()
+    sid = daily_session_id()
+    _import_session_daily_records(db, kind, sid)
+    version = db.execute(
+        "SELECT MAX(id) FROM daily_records WHERE kind = ? AND session_id = ?", (kind, sid)
+    ).fetchone()[0]
+    if version is None:
+        return None
+    site_json = app.json.dumps({k: project_data.get(k) for k in EXCEL_PROJECT_KEYS if k in project_data}, sort_keys=False)
+    return _cached_workmaster_excel(kind, sid, version, site_json)
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# nginx の前段がある場合、EXCEL_ACCEL_DIR に書き出したファイルを X-Accel-Redirect で配信させる。
+# EXCEL_ACCEL_URL は nginx 側の internal な location（EXCEL_ACCEL_DIR を alias で指す）
+EXCEL_ACCEL_DIR = os.environ.get('EXCEL_ACCEL_DIR')
+EXCEL_ACCEL_URL = os.environ.get('EXCEL_ACCEL_URL', '/internal-exports/')
+
+def excel_download_response(data, download_name):
+    """xlsx の bytes をダウンロードさせる応答を返す
+
+    EXCEL_ACCEL_DIR が設定されていれば内容のハッシュ名でファイルに書き出し（同じ内容なら再利用）、
+    本体の送信は nginx に任せてワーカーをすぐに空ける。
+    """
+    if not EXCEL_ACCEL_DIR:
+        return send_file(BytesIO(data), mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=download_name)
+    name = hashlib.sha256(data).hexdigest() + '.xlsx'
+    path = os.path.join(EXCEL_ACCEL_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(EXCEL_ACCEL_DIR, exist_ok=True)
+        # 書きかけのファイルを nginx に読ませないよう、一時ファイルに書いてから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=EXCEL_ACCEL_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp は 0600 で作るので、別ユーザーで動く nginx から読めるようにする
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    response = app.response_class(mimetype=XLSX_MIMETYPE)
+    response.headers['X-Accel-Redirect'] = EXCEL_ACCEL_URL + name
+    response.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+    response.cache_control.no_cache = True
+    return response
+
+def load_proto_project():
+    """セッションのプロトタイプ現場データを取得し、欠けているキーだけ既定値で補う
+
+    既定値の補完ではセッションへ書き戻さない（Cookie の再署名を避ける）。
+    """
+    project = session.get('proto_project_data') or {}
+    for key in _DEFAULT_PROTO_PROJECT.keys() - project.keys():
+        project[key] = copy.deepcopy(_DEFAULT_PROTO_PROJECT[key])
+    return project
+
+@functools.lru_cache(maxsize=256)
+def _endpoint_url(script_root, endpoint):
+    """引数なしの endpoint の URL（ルートは起動後に変わらないので、マウント位置ごとにプロセス内でキャッシュする）"""
+    try:
+        return url_for(endpoint)
+    except BuildError:
+        return '#'
 
 def safe_url_for(endpoint, **values):
-    """url_for を安全に呼び出す。存在しない endpoint の場合は '#' を返す"""
+    """url_for を安全に呼び出す。存在しない endpoint の場合は '#' を返す
+
+    引数なしの呼び出し（ナビのリンクなど）は SCRIPT_NAME ごとに結果をキャッシュし、
+    2 回目以降は URL マップを引かない。
+    未登録の endpoint は BuildError を投げさせず、登録済み view の辞書を引いて先に弾く。
+    """
+    if endpoint not in app.view_functions:
+        return '#'
+    if not values:
+        return _endpoint_url(request.script_root, endpoint)
     try:
         return url_for(endpoint, **values)
     except BuildError:
         return '#'
 
+def get_tag_list(tags_str):
+    """表示用に tags 列をタグのリストにする（空要素は除く）"""
+    return [t.strip() for t in (tags_str or '').split(',') if t.strip()]
+
 app.jinja_env.globals['safe_url_for'] = safe_url_for
+app.jinja_env.globals['get_tag_list'] = get_tag_list
 
-@app.context_processor
-def inject_global_config():
-    return {
-        'app_name': APP_CONFIG['app_name'],
-        'app_title': APP_CONFIG['app_title'],
-        'app_subtitle': APP_CONFIG['app_subtitle'],
-        'nav': APP_CONFIG['nav'],
-        'safe_url_for': safe_url_for,
-    }
+# テンプレート共通の値（起動時に一度だけ構築し、Jinja のグローバルに登録する。
+# context_processor と違い、描画のたびに呼び出してコンテキストへ展開する処理が要らない）
+_GLOBAL_CTX = MappingProxyType({
+    'app_name': APP_CONFIG['app_name'],
+    'app_title': APP_CONFIG['app_title'],
+    'app_subtitle': APP_CONFIG['app_subtitle'],
+    'nav': APP_CONFIG['nav'],
+    'safe_url_for': safe_url_for,
+})
+
+app.jinja_env.globals.update(_GLOBAL_CTX)
 
 # レートリミッター設定
-storage_uri = os.environ.get('RATELIMIT_STORAGE_URI', 'memory://')
+# memory:// はワーカーごとのカウンタになるため、複数ワーカーでは REDIS_URL で Redis を共有する
+storage_uri = os.environ.get('RATELIMIT_STORAGE_URI') or os.environ.get('REDIS_URL') or 'memory://'
 limiter = Limiter(
     key_func=get_remote_address,
     default_limits=["200 per hour"],
     storage_uri=storage_uri,
+    # fixed-window は 1 リクエストあたり Redis の INCR 1 回で済む
+    strategy=os.environ.get('RATELIMIT_STRATEGY', 'fixed-window'),
     app=app
 )
 
@@ -208,25 +819,29 @@ def index():
 @app.route('/workmaster_basic', methods=['GET', 'POST'])
 def workmaster_basic():
     if request.method == 'POST':
-        session['workmaster_basic'] = {
-            'site_name': request.form.get('site_name', ''),
-            'task_name': request.form.get('task_name', ''),
-            'period': request.form.get('period', ''),
-            'contractor': request.form.get('contractor', ''),
-            'machines': request.form.get('machines', ''),
-            'planned_quantity': safe_float(request.form.get('planned_quantity'), 0.0),
-            'planned_unit': request.form.get('planned_unit', ''),
-            'design_link': request.form.get('design_link', ''),
+        form = request.form
+        basic = {
+            'site_name': form.get('site_name', ''),
+            'task_name': form.get('task_name', ''),
+            'period': form.get('period', ''),
+            'contractor': form.get('contractor', ''),
+            'machines': form.get('machines', ''),
+            'planned_quantity': safe_float(form.get('planned_quantity'), 0.0),
+            'planned_unit': form.get('planned_unit', ''),
+            'design_link': form.get('design_link', ''),
             'budget': {
-                'labor': safe_float(request.form.get('budget_labor'), 0),
-                'machine': safe_float(request.form.get('budget_machine'), 0),
-                'materials': safe_float(request.form.get('budget_materials'), 0),
+                'labor': safe_float(form.get('budget_labor'), 0),
+                'machine': safe_float(form.get('budget_machine'), 0),
+                'materials': safe_float(form.get('budget_materials'), 0),
             },
-            'cycle_steps': request.form.getlist('step[]'),
-            'cycle_checks': request.form.getlist('check[]'),
-            'tool_list': request.form.get('tool_list', ''),
+            'cycle_steps': form.getlist('step[]'),
+            'cycle_checks': form.getlist('check[]'),
+            'tool_list': form.get('tool_list', ''),
         }
-        session['workmaster_data'] = session['workmaster_basic']
+        # Excel 出力用の作業サイクル文字列は設定変更時にだけ作る
+        basic['_cycle_summary'] = summarize_cycle_steps(basic['cycle_steps'])
+        session['workmaster_basic'] = basic
+        session['workmaster_data'] = basic
         return redirect(url_for('workmaster_detail'))
     data = session.get('workmaster_basic', {})
     return render_template('workmaster_basic.html', page_title='歩掛マスター：基本情報入力', current_app='workmaster', data=data, master_data=MASTER_DATA)
@@ -234,14 +849,15 @@ def workmaster_basic():
 @app.route('/workmaster_detail', methods=['GET', 'POST'])
 def workmaster_detail():
     if request.method == 'POST':
+        form = request.form
         session['workmaster_detail'] = {
-            'material_name': request.form.getlist('material_name[]'),
-            'material_qty': request.form.getlist('material_qty[]'),
-            'heavy_machine': request.form.get('heavy_machine', ''),
-            'person_count': request.form.get('person_count', ''),
-            'work_unit': request.form.get('work_unit', ''),
-            'work_cycle': request.form.get('work_cycle', ''),
-            'cycle_options': request.form.get('cycle_options', ''),
+            'material_name': form.getlist('material_name[]'),
+            'material_qty': form.getlist('material_qty[]'),
+            'heavy_machine': form.get('heavy_machine', ''),
+            'person_count': form.get('person_count', ''),
+            'work_unit': form.get('work_unit', ''),
+            'work_cycle': form.get('work_cycle', ''),
+            'cycle_options': form.get('cycle_options', ''),
         }
         return redirect(url_for('workmaster_daily'))
     data = session.get('workmaster_detail', {})
@@ -249,138 +865,65 @@ def workmaster_detail():
 
 @app.route('/workmaster_daily', methods=['GET', 'POST'])
 def workmaster_daily():
-    basic = session.get('workmaster_basic', {})
-    detail = session.get('workmaster_detail', {})
-    project_data = session.get('workmaster_data', basic if basic else {})
-    daily_records = session.get('workmaster_daily_records', [])
+    # session は LocalProxy なので実体を一度だけ取り出し、既定値の dict も必要なときだけ作る
+    sess = session._get_current_object()
+    basic = sess.get('workmaster_basic') or {}
+    detail = sess.get('workmaster_detail') or {}
+    project_data = sess.get('workmaster_data', basic)
     
     if request.method == 'POST':
-        machinery_list = request.form.getlist('machinery[]')
-        work_contents = request.form.getlist('work_content[]')
-        progress_value = safe_float(request.form.get('progress_value'))
-        progress_total = safe_float(request.form.get('progress_total'), project_data.get('planned_quantity', 0.0))
-        personnel = int(safe_float(request.form.get('personnel'), 0))
-        work_time = safe_float(request.form.get('work_time'), 0)
-
-        cycle_steps = request.form.getlist('cycle_step[]')
-        cycle_counts = request.form.getlist('cycle_count[]')
-        cycle_progresses = request.form.getlist('cycle_progress[]')
-        cycle_entries = []
-        for s, c, p in zip(cycle_steps, cycle_counts, cycle_progresses):
-            if not s:
-                continue
-            entry = {
-                'step': s,
-                'count': int(safe_float(c, 0)) if c else None,
-                'progress_pct': safe_float(p, None) if p else None,
-            }
-            cycle_entries.append(entry)
-
-        cost_personnel, cost_machinery, cost_total = calculate_daily_cost(personnel, work_time, machinery_list)
-
-        record = {
-            'date': request.form.get('record_date'),
-            'personnel': personnel,
-            'machinery': machinery_list,
-            'work_time': work_time,
-            'work_content': work_contents,
-            'progress_unit': request.form.get('progress_unit'),
-            'progress_value': progress_value,
-            'progress_total': progress_total,
-            'progress_value_float': progress_value,
-            'progress_total_float': progress_total,
-            'cycle_entries': cycle_entries,
-            'weather': request.form.get('weather'),
-            'remarks': request.form.get('remarks'),
-            'cost_personnel': cost_personnel,
-            'cost_machinery': cost_machinery,
-            'cost_total': cost_total,
-        }
-        daily_records.append(record)
-        session['workmaster_daily_records'] = daily_records
-        update_project_from_daily(project_data, daily_records, session_key='workmaster_data')
+        record = build_daily_record(request.form, project_data.get('planned_quantity', 0.0))
+        save_daily_record('workmaster', record)
         return redirect(url_for('workmaster_daily'))
     
-    recent_records = daily_records[::-1]
-    return render_template('workmaster_daily.html', page_title='歩掛マスター：日次記録', current_app='workmaster', basic=basic, detail=detail, records=recent_records, project_data=project_data, master_data=MASTER_DATA)
+    project_data = project_with_totals(project_data, 'workmaster')
+    # 表示は新しい順。DB から ORDER BY id DESC のまま受け取り、並べ替えやコピーはしない
+    daily_records = load_daily_records('workmaster', limit=DAILY_RECORDS_DISPLAY_LIMIT, newest_first=True)
+
+    return render_template('workmaster_daily.html', page_title='歩掛マスター：日次記録', current_app='workmaster', basic=basic, detail=detail, records=daily_records, project_data=project_data, master_data=MASTER_DATA)
 
 @app.route('/workmaster_export_excel')
 def workmaster_export_excel():
-    basic = session.get('workmaster_basic', {})
-    detail = session.get('workmaster_detail', {})
-    daily_records = session.get('workmaster_daily_records', [])
-    project_data = session.get('workmaster_data', basic if basic else {})
-    
-    if not daily_records:
-        flash('記録データがありません。', 'warning')
-        return redirect(url_for('workmaster_daily'))
+    sess = session._get_current_object()
+    basic = sess.get('workmaster_basic') or {}
+    project_data = sess.get('workmaster_data', basic)
     
     try:
-        flattened = []
-        for rec in daily_records:
-            rec_copy = rec.copy()
-            if isinstance(rec_copy.get('machinery'), list):
-                rec_copy['machinery'] = ", ".join(rec_copy['machinery'])
-            flattened.append(rec_copy)
-
-        df = pd.DataFrame(flattened)
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            # 日次記録シート
-            df.to_excel(writer, sheet_name='日次記録', index=False)
-            
-            # 現場設定シート
-            site_info = pd.Series({
-                '現場名': project_data.get('site_name', 'N/A'),
-                '作業名': project_data.get('task_name', 'N/A'),
-                '道具': project_data.get('tool_list', 'N/A'),
-                '作業サイクル': ", ".join([f"{s}" for s in project_data.get('cycle_steps', [])]),
-            })
-            site_df = pd.DataFrame(site_info).T
-            site_df.to_excel(writer, sheet_name='現場設定', index=False)
-        
-        output.seek(0)
-        return send_file(output, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                        as_attachment=True, download_name='workmaster_export.xlsx')
+        data = workmaster_excel_bytes('workmaster', project_data)
     except Exception as e:
         flash(f'Excel出力に失敗しました: {e}', 'danger')
         return redirect(url_for('workmaster_daily'))
+    
+    if data is None:
+        flash('記録データがありません。', 'warning')
+        return redirect(url_for('workmaster_daily'))
+    return excel_download_response(data, 'workmaster_export.xlsx')
 
 # ===== 歩掛マスター（プロトタイプ） =====
 @app.route('/workmaster_proto_basic', methods=['GET', 'POST'])
 def workmaster_proto_basic():
-    project = session.get('proto_project_data', {})
-    if not project:
-        project = {
-            'site_name': '未設定の現場',
-            'task_name': '未設定の作業',
-            'planned_quantity': 0.0,
-            'planned_unit': '',
-            'cycle_steps': [],
-            'cycle_checks': [],
-            'budget': {'labor': 0, 'machine': 0, 'materials': 0},
-            'design_link': '',
-            'phase': '施工前',
-            'progress_pct': 0.0,
-            'actual_cost': 0.0,
-        }
+    project = load_proto_project()
     
     if request.method == 'POST':
+        form = request.form
+        budget = project.get('budget', {})
         project.update({
-            'site_name': request.form.get('site_name', project.get('site_name', '')),
-            'task_name': request.form.get('task_name', project.get('task_name', '')),
-            'planned_quantity': safe_float(request.form.get('planned_quantity'), project.get('planned_quantity', 0.0)),
-            'planned_unit': request.form.get('planned_unit', project.get('planned_unit', '')),
-            'design_link': request.form.get('design_link', project.get('design_link', '')),
+            'site_name': form.get('site_name', project.get('site_name', '')),
+            'task_name': form.get('task_name', project.get('task_name', '')),
+            'planned_quantity': safe_float(form.get('planned_quantity'), project.get('planned_quantity', 0.0)),
+            'planned_unit': form.get('planned_unit', project.get('planned_unit', '')),
+            'design_link': form.get('design_link', project.get('design_link', '')),
             'budget': {
-                'labor': safe_float(request.form.get('budget_labor'), project.get('budget', {}).get('labor', 0)),
-                'machine': safe_float(request.form.get('budget_machine'), project.get('budget', {}).get('machine', 0)),
-                'materials': safe_float(request.form.get('budget_materials'), project.get('budget', {}).get('materials', 0)),
+                'labor': safe_float(form.get('budget_labor'), budget.get('labor', 0)),
+                'machine': safe_float(form.get('budget_machine'), budget.get('machine', 0)),
+                'materials': safe_float(form.get('budget_materials'), budget.get('materials', 0)),
             },
-            'cycle_steps': request.form.getlist('step[]'),
-            'cycle_checks': request.form.getlist('check[]'),
-            'tool_list': request.form.get('tool_list', ''),
+            'cycle_steps': form.getlist('step[]'),
+            'cycle_checks': form.getlist('check[]'),
+            'tool_list': form.get('tool_list', ''),
         })
+        # Excel 出力用の作業サイクル文字列は設定変更時にだけ作る
+        project['_cycle_summary'] = summarize_cycle_steps(project['cycle_steps'])
         session['proto_project_data'] = project
         return redirect(url_for('workmaster_proto_daily'))
 
@@ -394,130 +937,161 @@ def workmaster_proto_basic():
 
 @app.route('/workmaster_proto_daily', methods=['GET', 'POST'])
 def workmaster_proto_daily():
-    project_data = session.get('proto_project_data', {})
-    if not project_data:
-        project_data = {
-            'site_name': '未設定の現場',
-            'task_name': '未設定の作業',
-            'planned_quantity': 0.0,
-            'planned_unit': '',
-            'cycle_steps': [],
-            'cycle_checks': [],
-            'budget': {'labor': 0, 'machine': 0, 'materials': 0},
-            'design_link': '',
-            'phase': '施工前',
-            'progress_pct': 0.0,
-            'actual_cost': 0.0,
-        }
+    project_data = load_proto_project()
     
-    daily_records = session.get('proto_daily_records', [])
     if request.method == 'POST':
-        machinery_list = request.form.getlist('machinery[]')
-        work_contents = request.form.getlist('work_content[]')
-        progress_value = safe_float(request.form.get('progress_value'))
-        progress_total = safe_float(request.form.get('progress_total'), project_data.get('planned_quantity', 0.0))
-        personnel = int(safe_float(request.form.get('personnel'), 0))
-        work_time = safe_float(request.form.get('work_time'), 0)
-
-        cycle_steps = request.form.getlist('cycle_step[]')
-        cycle_counts = request.form.getlist('cycle_count[]')
-        cycle_progresses = request.form.getlist('cycle_progress[]')
-        cycle_entries = []
-        for s, c, p in zip(cycle_steps, cycle_counts, cycle_progresses):
-            if not s:
-                continue
-            entry = {
-                'step': s,
-                'count': int(safe_float(c, 0)) if c else None,
-                'progress': safe_float(p, None) if p else None,
-            }
-            cycle_entries.append(entry)
-
-        cost_personnel, cost_machinery, cost_total = calculate_daily_cost(personnel, work_time, machinery_list)
-
-        record = {
-            'date': request.form.get('record_date'),
-            'personnel': personnel,
-            'machinery': machinery_list,
-            'work_time': work_time,
-            'work_content': work_contents,
-            'progress_unit': request.form.get('progress_unit'),
-            'progress_value': progress_value,
-            'progress_total': progress_total,
-            'progress_value_float': progress_value,
-            'progress_total_float': progress_total,
-            'cycle_entries': cycle_entries,
-            'weather': request.form.get('weather'),
-            'remarks': request.form.get('remarks'),
-            'cost_personnel': cost_personnel,
-            'cost_machinery': cost_machinery,
-            'cost_total': cost_total,
-        }
-        daily_records.append(record)
-        session['proto_daily_records'] = daily_records
-        update_project_from_daily(project_data, daily_records, session_key='proto_project_data')
+        record = build_daily_record(request.form, project_data.get('planned_quantity', 0.0), progress_key='progress')
+        save_daily_record('proto', record)
         return redirect(url_for('workmaster_proto_daily'))
 
-    recent_records = daily_records[::-1]
+    project_data = project_with_totals(project_data, 'proto')
+    # 表示は新しい順。DB から ORDER BY id DESC のまま受け取り、並べ替えやコピーはしない
+    daily_records = load_daily_records('proto', limit=DAILY_RECORDS_DISPLAY_LIMIT, newest_first=True)
+
     return render_template(
         'workmaster_proto_daily.html',
         page_title='歩掛マスター（日報・プロトタイプ）',
         current_app='workmaster_proto',
         project_data=project_data,
-        recent_records=recent_records,
+        records=daily_records,
         master_data=MASTER_DATA,
     )
 
 @app.route('/workmaster_proto_export')
 def workmaster_proto_export():
-    daily_records = session.get('proto_daily_records', [])
     project_data = session.get('proto_project_data', {})
-    if not daily_records:
-        flash('記録データがありません。', 'warning')
-        return redirect(url_for('workmaster_proto_daily'))
-
     try:
-        flattened = []
-        for rec in daily_records:
-            rec_copy = rec.copy()
-            if isinstance(rec_copy.get('machinery'), list):
-                rec_copy['machinery'] = ", ".join(rec_copy['machinery'])
-            flattened.append(rec_copy)
-
-        df = pd.DataFrame(flattened)
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            # 日次記録シート
-            df.to_excel(writer, sheet_name='日次記録', index=False)
-            
-            # 現場設定シート
-            site_info = pd.Series({
-                '現場名': project_data.get('site_name', 'N/A'),
-                '作業名': project_data.get('task_name', 'N/A'),
-                '道具': project_data.get('tool_list', 'N/A'),
-                '作業サイクル': ", ".join([f"{s}" for s in project_data.get('cycle_steps', [])]),
-            })
-            site_df = pd.DataFrame(site_info).T
-            site_df.to_excel(writer, sheet_name='現場設定', index=False)
-        
-        output.seek(0)
-        return send_file(output, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                        as_attachment=True, download_name='workmaster_proto_export.xlsx')
+        data = workmaster_excel_bytes('proto', project_data)
     except Exception as e:
         flash(f'Excel出力に失敗しました: {e}', 'danger')
         return redirect(url_for('workmaster_proto_daily'))
 
+    if data is None:
+        flash('記録データがありません。', 'warning')
+        return redirect(url_for('workmaster_proto_daily'))
+    return excel_download_response(data, 'workmaster_proto_export.xlsx')
+
 # ===== HEIC to JPG 変換 =====
+# デコード・エンコード中は GIL が解放されるため、複数ファイルはスレッドで並列変換する。
+# 各ファイルは実行されるスレッド内で読み込むので、同時にメモリへ載るのは最大ワーカー数分
+HEIC_MAX_WORKERS = int(os.environ.get('HEIC_MAX_WORKERS', os.cpu_count() or 1))
+# 写真なら 85 で見た目はほぼ変わらず、エンコード量と出力サイズが大きく減る
+HEIC_JPEG_QUALITY = int(os.environ.get('HEIC_JPEG_QUALITY', 85))
+# 縮小後の長辺（converter.html の選択肢と揃える）。これ以外の値は元のサイズのまま変換する
+HEIC_TARGET_SIZES = MappingProxyType({'3840': 3840, '1920': 1920, '1280': 1280})
+
+@functools.lru_cache(maxsize=1)
+def heic_executor():
+    """変換用スレッドプール（最初の変換時に作る）
+
+    gevent ワーカーでは threading がグリーンレットに置き換わり、通常のスレッドプールでは
+    1 本の OS スレッド上で順番に変換されてしまう。その場合は gevent のネイティブスレッドプールを
+    使い、GIL を解放するデコード・エンコードを複数コアで並列に走らせる。
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+            return NativeThreadPoolExecutor(max_workers=HEIC_MAX_WORKERS)
+    except ImportError:
+        pass
+    return ThreadPoolExecutor(max_workers=HEIC_MAX_WORKERS, thread_name_prefix='heic')
+
+# Pillow / pillow_heif は重いので、実際に変換するときに読み込む。
+# ページの表示ではインストールされているかを find_spec で調べるだけにする
+HEIF_INSTALLED = importlib.util.find_spec('pillow_heif') is not None
+
+@functools.lru_cache(maxsize=1)
+def heif_available():
+    """pillow_heif を読み込んで HEIF オープナーを登録する（結果はキャッシュ）"""
+    from PIL import features
+    # JPEG エンコードが SIMD 版 (libjpeg-turbo) かどうかを記録する
+    if not features.check_feature('libjpeg_turbo'):
+        logging.getLogger(__name__).warning('Pillow が libjpeg-turbo なしでビルドされています。HEIC→JPG 変換が遅くなります。')
+    try:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+        return True
+    except Exception:
+        return False
+
 @app.route('/converter')
 def converter_page():
     """HEIC to JPG 変換ページ"""
     ctx = {
         'page_title': 'HEIC to JPG 変換',
         'current_app': 'converter',
-        'HEIF_AVAILABLE': HEIF_AVAILABLE
+        'HEIF_AVAILABLE': HEIF_INSTALLED
     }
     return render_template('converter.html', **ctx)
 
+def convert_heic_to_jpg(source, max_size=None):
+    """HEIC/HEIF（バイト列またはシーク可能なファイル）を JPEG のバイト列に変換する（EXIF は引き継ぐ）
+
+    max_size を指定すると長辺をその px 以内に縮小する。draft() に対応したデコーダでは
+    デコード時点で間引くため速いが、画質がわずかに落ちることがある。
+    """
+    from PIL import Image
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    img = Image.open(source)
+    
+    exif = img.info.get('exif', None)
+    if max_size:
+        img.draft('RGB', (max_size, max_size))
+    # pillow_heif は通常 RGB で返すので、その場合は convert() による全画素のコピーを省く
+    rgb = img if img.mode == 'RGB' else img.convert('RGB')
+    if max_size:
+        rgb.thumbnail((max_size, max_size))
+    
+    jpg_buffer = io.BytesIO()
+    save_kwargs = {'format': 'JPEG', 'quality': HEIC_JPEG_QUALITY}
+    if exif:
+        save_kwargs['exif'] = exif
+    
+    rgb.save(jpg_buffer, **save_kwargs)
+    return jpg_buffer.getvalue()
+
+def _convert_heic_upload(upload, max_size=None):
+    """スレッドプール用：アップロード 1 件（ファイル名, ストリーム）を変換する
+
+    Werkzeug は大きなアップロードを一時ファイルに退避しているので、read() でメモリへ
+    複製せずストリームのまま Pillow に渡す。失敗時は例外を返し、ログは呼び出し側で出す
+    （gevent のネイティブスレッドからはロックを使う logging を呼ばない）。
+    """
+    try:
+        return convert_heic_to_jpg(upload[1], max_size)
+    except Exception as e:
+        return e
+
+def _converted_or_none(upload, result):
+    """変換結果が例外ならログに出して None にする"""
+    if isinstance(result, Exception):
+        logging.warning(f"ファイル '{upload[0]}' の変換に失敗: {result}")
+        return None
+    return result
+
+class _ZipStreamBuffer:
+    """ZipFile の書き込み先。書かれたバイト列をためておき、take() でまとめて取り出す
+
+    シークできないので、ZipFile はデータディスクリプタ付きの形式で順に書き出す。
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
 @app.route('/convert', methods=['POST'])
 @limiter.limit("30 per hour")
 def convert_file():
@@ -527,93 +1101,134 @@ def convert_file():
         flash('ファイルが選択されていません。', 'warning')
         return redirect(url_for('converter_page'))
     
-    if not HEIF_AVAILABLE:
+    if not heif_available():
         flash('サーバーに HEIC を処理するライブラリ(pillow-heif)がインストールされていません。', 'danger')
         return redirect(url_for('converter_page'))
     
-    zip_buffer = io.BytesIO()
-    converted_count = 0
+    targets = [f for f in heic_files if f.filename and f.filename.lower().endswith(('.heic', '.heif'))]
+    max_size = HEIC_TARGET_SIZES.get(request.form.get('target_size', ''))
+    convert_one = functools.partial(_convert_heic_upload, max_size=max_size)
     
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for heic in heic_files:
-            if heic.filename == '' or not heic.filename.lower().endswith(('.heic', '.heif')):
-                continue
-            
-            try:
-                original_name = heic.filename
-                base = os.path.splitext(original_name)[0]
-                jpg_filename = f'{base}.jpg'
-                
-                data = heic.read()
-                img = Image.open(io.BytesIO(data))
-                
-                exif = img.info.get('exif', None)
-                rgb = img.convert('RGB')
-                
-                jpg_buffer = io.BytesIO()
-                save_kwargs = {'format': 'JPEG', 'quality': 95}
-                if exif:
-                    save_kwargs['exif'] = exif
-                
-                rgb.save(jpg_buffer, **save_kwargs)
-                jpg_buffer.seek(0)
-                
-                zf.writestr(jpg_filename, jpg_buffer.getvalue())
-                converted_count += 1
-            except Exception as e:
-                logging.warning(f"ファイル '{heic.filename}' の変換に失敗: {e}")
-                pass
+    # Werkzeug はリクエスト終了時にアップロードを閉じるが、Zip は応答を返した後も書き続ける。
+    # ストリームはこちらで引き取り、generate() の最後に閉じる
+    uploads = []
+    for f in targets:
+        uploads.append((f.filename, f.stream))
+        f.stream = io.BytesIO()
+    
+    def close_uploads():
+        for _, stream in uploads:
+            stream.close()
+    
+    results = ((upload, _converted_or_none(upload, result))
+               for upload, result in zip(uploads, heic_executor().map(convert_one, uploads)))
     
-    if converted_count == 0:
+    # 最初の 1 件が変換できるまで待ってから応答を始める（全件失敗ならリダイレクトで知らせる）
+    first = next(((upload, jpg_data) for upload, jpg_data in results if jpg_data is not None), None)
+    if first is None:
+        close_uploads()
         flash('有効なHEICファイルの変換にすべて失敗しました。', 'danger')
         return redirect(url_for('converter_page'))
     
-    zip_buffer.seek(0)
-    flash(f'{converted_count} 件のHEICファイルをJPGに変換しました。', 'success')
-    return send_file(zip_buffer, mimetype='application/zip', as_attachment=True, download_name='Converted_HEIC_Files.zip')
+    def generate():
+        # 変換はスレッドプールで並列に行い、ZipFile への書き込みはこのジェネレータだけで行う。
+        # JPEG はすでに圧縮済みで deflate してもほぼ縮まないため、無圧縮で格納する
+        try:
+            sink = _ZipStreamBuffer()
+            with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+                for (filename, _), jpg_data in itertools.chain([first], results):
+                    if jpg_data is None:
+                        continue
+                    base = os.path.splitext(filename)[0]
+                    zf.writestr(f'{base}.jpg', jpg_data)
+                    yield sink.take()
+            yield sink.take()
+        finally:
+            close_uploads()
+    
+    flash('HEICファイルをJPGに変換しました。変換できなかったファイルは Zip に含まれません。', 'success')
+    return app.response_class(
+        generate(),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=Converted_HEIC_Files.zip'},
+    )
 
 # ===== 単位換算 =====
+# 換算表はリクエストごとに作り直さないようモジュールレベルの読み取り専用定数にする
+MATERIALS = MappingProxyType({
+    'soil_compacted': MappingProxyType({'label': '土(締固め)', 'density': 1700}),
+    'crushed_stone': MappingProxyType({'label': '砕石', 'density': 2000}),
+    'concrete_rebar': MappingProxyType({'label': 'コンクリート（有筋）', 'density': 2400}),
+    'concrete_plain': MappingProxyType({'label': 'コンクリート（無筋）', 'density': 2350}),
+    'asphalt': MappingProxyType({'label': 'アスファルト', 'density': 2300}),
+    'steel': MappingProxyType({'label': '鋼材', 'density': 7850}),
+})
+LENGTH_TABLE = MappingProxyType({'m':1.0, 'cm':0.01, 'mm':0.001, 'km':1000.0, 'ft':0.3048, 'in':0.0254})
+WEIGHT_TABLE = MappingProxyType({'kg':1.0, 'g':0.001, 't':1000.0, 'lb':0.45359237})
+VOLUME_TABLE = MappingProxyType({'m3':1.0, 'l':0.001, 'ml':0.000001})
+UNIT_TABLES = MappingProxyType({
+    'length': LENGTH_TABLE,
+    'weight': WEIGHT_TABLE,
+    'volume': VOLUME_TABLE,
+})
+
+# 単位・材料の換算倍率は全組み合わせを起動時に計算しておき、リクエストでは 1 回引いて掛けるだけにする
+UNIT_FACTORS = MappingProxyType({
+    (category, frm, to): (1.0 if frm == to else table[frm] / table[to])
+    for category, table in UNIT_TABLES.items()
+    for frm in table
+    for to in table
+})
+MATERIAL_FACTORS = MappingProxyType({
+    **{
+        (key, 'vol_to_mass', vol_unit, mass_unit): VOLUME_TABLE[vol_unit] * mat['density'] / WEIGHT_TABLE[mass_unit]
+        for key, mat in MATERIALS.items() for vol_unit in VOLUME_TABLE for mass_unit in WEIGHT_TABLE
+    },
+    **{
+        (key, 'mass_to_vol', vol_unit, mass_unit): WEIGHT_TABLE[mass_unit] / mat['density'] / VOLUME_TABLE[vol_unit]
+        for key, mat in MATERIALS.items() for vol_unit in VOLUME_TABLE for mass_unit in WEIGHT_TABLE
+    },
+})
+
+def unit_factor(category, frm, to):
+    """category 内で frm → to へ換算する倍率を返す（不正な指定は ValueError）"""
+    factor = UNIT_FACTORS.get((category, frm, to))
+    if factor is None:
+        raise ValueError('未対応のカテゴリ' if category not in UNIT_TABLES else '不正な単位')
+    return factor
+
+def convert_unit(value, category, frm, to):
+    """value を category 内で frm から to へ換算する"""
+    factor = unit_factor(category, frm, to)
+    if factor == 1.0:
+        return value
+    return value * factor
+
+def material_factor(material_key, direction, vol_unit, mass_unit):
+    """材料の体積⇔質量の換算倍率（direction が vol_to_mass 以外は質量→体積）"""
+    if material_key not in MATERIALS:
+        raise ValueError('不正な材料')
+    direction = 'vol_to_mass' if direction == 'vol_to_mass' else 'mass_to_vol'
+    factor = MATERIAL_FACTORS.get((material_key, direction, vol_unit, mass_unit))
+    if factor is None:
+        raise ValueError('不正な単位')
+    return factor
+
 @app.route('/unit_converter', methods=['GET', 'POST'])
 def unit_converter_page():
-    MATERIALS = {
-        'soil_compacted': {'label': '土(締固め)', 'density': 1700},
-        'crushed_stone': {'label': '砕石', 'density': 2000},
-        'concrete_rebar': {'label': 'コンクリート（有筋）', 'density': 2400},
-        'concrete_plain': {'label': 'コンクリート（無筋）', 'density': 2350},
-        'asphalt': {'label': 'アスファルト', 'density': 2300},
-        'steel': {'label': '鋼材', 'density': 7850},
-    }
-    
     result = None
     if request.method == 'POST':
+        form = request.form
         try:
-            mode = request.form.get('mode', 'unit')
-            weight_table = {'kg':1.0, 'g':0.001, 't':1000.0, 'lb':0.45359237}
-            volume_table = {'m3':1.0, 'l':0.001, 'ml':0.000001}
+            mode = form.get('mode', 'unit')
             
             if mode == 'unit':
-                category = request.form.get('category', 'length')
-                value = float(request.form.get('value', '0') or 0)
-                frm = request.form.get('from_unit')
-                to = request.form.get('to_unit')
-                
-                def convert(value, frm, to, table):
-                    base = value * table[frm]
-                    return base / table[to]
-                
-                if category == 'length':
-                    table = {'m':1.0, 'cm':0.01, 'mm':0.001, 'km':1000.0, 'ft':0.3048, 'in':0.0254}
-                elif category == 'weight':
-                    table = weight_table
-                elif category == 'volume':
-                    table = volume_table
-                else:
-                    raise ValueError('未対応のカテゴリ')
+                category = form.get('category', 'length')
+                value = float(form.get('value', '0') or 0)
+                frm = form.get('from_unit')
+                to = form.get('to_unit')
                 
-                if frm not in table or to not in table:
-                    raise ValueError('不正な単位')
-                
-                out_val = convert(value, frm, to, table)
+                out_val = convert_unit(value, category, frm, to)
                 result = {
                     'mode': 'unit',
                     'value': value,
@@ -622,47 +1237,28 @@ def unit_converter_page():
                     'out': round(out_val, 6)
                 }
             else:  # material mode
-                direction = request.form.get('direction', 'vol_to_mass')
-                value = float(request.form.get('value', '0') or 0)
-                vol_unit = request.form.get('vol_unit', 'm3')
-                mass_unit = request.form.get('mass_unit', 'kg')
-                material_key = request.form.get('material')
-                if material_key not in MATERIALS:
-                    raise ValueError('不正な材料')
-                
-                density = MATERIALS[material_key]['density']
-                
-                if vol_unit not in volume_table or mass_unit not in weight_table:
-                    raise ValueError('不正な単位')
+                direction = form.get('direction', 'vol_to_mass')
+                value = float(form.get('value', '0') or 0)
+                vol_unit = form.get('vol_unit', 'm3')
+                mass_unit = form.get('mass_unit', 'kg')
+                material_key = form.get('material')
                 
+                out_val = value * material_factor(material_key, direction, vol_unit, mass_unit)
+                material = MATERIALS[material_key]
                 if direction == 'vol_to_mass':
-                    vol_m3 = value * volume_table[vol_unit]
-                    mass_kg = vol_m3 * density
-                    out_mass = mass_kg / weight_table[mass_unit]
-                    result = {
-                        'mode': 'material',
-                        'direction': direction,
-                        'material': MATERIALS[material_key]['label'],
-                        'value': value,
-                        'from_unit': vol_unit,
-                        'to_unit': mass_unit,
-                        'out': round(out_mass, 6),
-                        'density': density
-                    }
+                    from_unit, to_unit = vol_unit, mass_unit
                 else:
-                    mass_kg = value * weight_table[mass_unit]
-                    vol_m3 = mass_kg / density
-                    out_vol = vol_m3 / volume_table[vol_unit]
-                    result = {
-                        'mode': 'material',
-                        'direction': direction,
-                        'material': MATERIALS[material_key]['label'],
-                        'value': value,
-                        'from_unit': mass_unit,
-                        'to_unit': vol_unit,
-                        'out': round(out_vol, 6),
-                        'density': density
-                    }
+                    from_unit, to_unit = mass_unit, vol_unit
+                result = {
+                    'mode': 'material',
+                    'direction': direction,
+                    'material': material['label'],
+                    'value': value,
+                    'from_unit': from_unit,
+                    'to_unit': to_unit,
+                    'out': round(out_val, 6),
+                    'density': material['density']
+                }
         except Exception as e:
             flash(f'換算に失敗しました: {e}', 'danger')
     
@@ -683,61 +1279,132 @@ def dxf_tool_page():
     }
     return render_template('dxf_tool.html', **ctx)
 
+def _parse_coordinate_fields(line):
+    """空欄を含む・数値でないなどの行を、カンマ区切りの各欄を見て解釈する（不正なら None）"""
+    parts = [p.strip() for p in line.split(',') if p.strip()]
+    if len(parts) < 2:
+        return None
+    try:
+        x = float(parts[-2])
+        y = float(parts[-1])
+    except ValueError:
+        return None
+    return {'label': ','.join(parts[:-2]), 'x': x, 'y': y}
+
+def parse_coordinates(coord_text):
+    """「ラベル,X,Y」または「X,Y」形式の行を座標リストに変換する（不正な行は読み飛ばす）
+
+    大半の行は末尾 2 欄が数値なので、右から 2 回 rpartition して float に渡すだけで済ませる。
+    それで読めない行だけ各欄を分割して解釈し、結果は同じになるようにする。
+    """
+    points = []
+    append = points.append
+    for line in coord_text.splitlines():
+        head, _, ys = line.rpartition(',')
+        label, _, xs = head.rpartition(',')
+        try:
+            x = float(xs)
+            y = float(ys)
+        except ValueError:
+            point = _parse_coordinate_fields(line)
+            if point is not None:
+                append(point)
+            continue
+        label = label.strip()
+        if ',' in label:
+            label = ','.join(p.strip() for p in label.split(',') if p.strip())
+        append({'label': label, 'x': x, 'y': y})
+    return points
+
+# R12 (AC1009) 形式の DXF を文字列で直接組み立てる。エンティティは POINT と TEXT だけなので、
+# ezdxf でドキュメントのオブジェクトを組み立てるより大幅に速い
+DXF_HEADER = (
+    "0\nSECTION\n2\nHEADER\n9\n$ACADVER\n1\nAC1009\n9\n$DWGCODEPAGE\n3\nANSI_932\n0\nENDSEC\n"
+    "0\nSECTION\n2\nTABLES\n"
+    "0\nTABLE\n2\nLTYPE\n70\n1\n0\nLTYPE\n2\nCONTINUOUS\n70\n0\n3\nSolid line\n72\n65\n73\n0\n40\n0.0\n0\nENDTAB\n"
+    "0\nTABLE\n2\nLAYER\n70\n1\n0\nLAYER\n2\n{layer}\n70\n0\n62\n7\n6\nCONTINUOUS\n0\nENDTAB\n"
+    "0\nENDSEC\n"
+    "0\nSECTION\n2\nENTITIES\n"
+)
+DXF_FOOTER = "0\nENDSEC\n0\nEOF\n"
+# 日本語のラベル・画層名は R12 の慣例どおり Shift_JIS（ANSI_932）で書く
+DXF_ENCODING = 'cp932'
+DXF_TEXT_HEIGHT = 0.25
+DXF_LABEL_OFFSET = 0.2
+# 画層名に使えない記号（AutoCAD は読み込み時にエラーにする）
+DXF_LAYER_INVALID_RE = re.compile(r'[<>/\\":;?*|=`]')
+
+def dxf_text(value):
+    """DXF の文字列値にする。改行などの制御文字は除き、Shift_JIS にない文字は \\U+XXXX で表す"""
+    value = str(value)
+    if value.isascii() and value.isprintable():
+        return value
+    out = []
+    for ch in value:
+        if ch < ' ':
+            continue
+        if ch >= '\x80':
+            try:
+                ch.encode(DXF_ENCODING)
+            except UnicodeEncodeError:
+                # \U+ は 4 桁までなので、基本多言語面の外の文字（絵文字など）は ? にする
+                ch = f'\\U+{ord(ch):04X}' if ord(ch) <= 0xFFFF else '?'
+        out.append(ch)
+    return ''.join(out)
+
+def dxf_layer_name(value):
+    """画層名にする。使えない記号と Shift_JIS にない文字は _ に置き換え、空なら POINTS にする
+
+    \\U+XXXX の表記は \\ を含み画層名には使えないので、dxf_text() とは別に扱う。
+    """
+    out = []
+    for ch in DXF_LAYER_INVALID_RE.sub('_', str(value)):
+        if ch < ' ':
+            continue
+        if ch >= '\x80':
+            try:
+                ch.encode(DXF_ENCODING)
+            except UnicodeEncodeError:
+                ch = '_'
+        out.append(ch)
+    return ''.join(out).strip() or 'POINTS'
+
+def build_dxf(points, layer_name):
+    """座標リストから POINT（ラベルがあれば TEXT も）を並べた DXF の文字列を作る"""
+    layer = dxf_layer_name(layer_name)
+    parts = [DXF_HEADER.format(layer=layer)]
+    append = parts.append
+    for pt in points:
+        x, y = pt['x'], pt['y']
+        append(f"0\nPOINT\n8\n{layer}\n10\n{x!r}\n20\n{y!r}\n30\n0.0\n")
+        if pt['label']:
+            append(
+                f"0\nTEXT\n8\n{layer}\n10\n{x + DXF_LABEL_OFFSET!r}\n20\n{y + DXF_LABEL_OFFSET!r}\n30\n0.0\n"
+                f"40\n{DXF_TEXT_HEIGHT!r}\n1\n{dxf_text(pt['label'])}\n"
+            )
+    append(DXF_FOOTER)
+    return ''.join(parts)
+
 @app.route('/generate_dxf', methods=['POST'])
 @limiter.limit("60 per hour")
 def generate_dxf():
-    coord_text = (request.form.get('coordinate_data') or '').strip()
-    layer_name = (request.form.get('app_layer') or 'POINTS').strip()
-    filename = (request.form.get('dxf_name') or 'coordinate_output').strip()
+    form = request.form
+    coord_text = (form.get('coordinate_data') or '').strip()
+    layer_name = (form.get('app_layer') or 'POINTS').strip()
+    filename = (form.get('dxf_name') or 'coordinate_output').strip()
     
     if not coord_text:
         flash('座標データが入力されていません。', 'warning')
         return redirect(url_for('dxf_tool_page'))
     
-    points = []
-    for raw_line in coord_text.splitlines():
-        line = raw_line.strip()
-        if not line:
-            continue
-        parts = [p.strip() for p in line.split(',') if p.strip()]
-        if len(parts) == 1:
-            continue
-        if len(parts) == 2:
-            label = ''
-            try:
-                x = float(parts[0])
-                y = float(parts[1])
-            except Exception:
-                continue
-        else:
-            try:
-                x = float(parts[-2])
-                y = float(parts[-1])
-                label = ','.join(parts[:-2])
-            except Exception:
-                continue
-        points.append({'label': label, 'x': x, 'y': y})
+    points = parse_coordinates(coord_text)
     
     if not points:
         flash('有効な座標が見つかりませんでした。フォーマットを確認してください。', 'warning')
         return redirect(url_for('dxf_tool_page'))
     
     try:
-        doc = ezdxf.new(dxfversion='R2010')
-        if layer_name not in doc.layers:
-            doc.layers.new(name=layer_name)
-        msp = doc.modelspace()
-        
-        for pt in points:
-            x, y = pt['x'], pt['y']
-            msp.add_point((x, y), dxfattribs={'layer': layer_name})
-            if pt['label']:
-                txt = msp.add_text(str(pt['label']), dxfattribs={'height': 0.25, 'layer': layer_name})
-                txt.set_pos((x + 0.2, y + 0.2), align='LEFT')
-        
-        buf = BytesIO()
-        doc.saveas(buf)
-        buf.seek(0)
+        buf = BytesIO(build_dxf(points, layer_name).encode(DXF_ENCODING))
         download_name = f"{filename}.dxf"
         return send_file(buf, mimetype='application/dxf', as_attachment=True, download_name=download_name)
     except Exception as e:
@@ -765,7 +1432,8 @@ def comparison_tool_page():
     session.permanent = True
     
     if request.method == 'POST':
-        action = request.form.get('action')
+        form = request.form
+        action = form.get('action')
         
         # セッションから現在のテーブルデータを取得
         columns = session.get('comparison_columns', [])
@@ -788,7 +1456,7 @@ def comparison_tool_page():
         
         # 行を追加（比較項目を追加）
         elif action == 'add_row':
-            row_type = request.form.get('row_type', 'text')
+            row_type = form.get('row_type', 'text')
             row_id = max([r['id'] for r in rows], default=-1) + 1
             row_label = {'text': '新規項目', 'number': '数値項目', 'textarea': '説明'}[row_type]
             rows.append({'id': row_id, 'label': row_label, 'type': row_type})
@@ -798,7 +1466,7 @@ def comparison_tool_page():
         # 列を削除（製品を削除）
         elif action == 'delete_column':
             try:
-                col_id = int(request.form.get('col_id'))
+                col_id = int(form.get('col_id'))
                 col_id_str = str(col_id)
                 columns = [c for c in columns if c['id'] != col_id]
                 session['comparison_columns'] = columns
@@ -815,7 +1483,7 @@ def comparison_tool_page():
         # 行を削除（比較項目を削除）
         elif action == 'delete_row':
             try:
-                row_id = int(request.form.get('row_id'))
+                row_id = int(form.get('row_id'))
                 row_id_str = str(row_id)
                 rows = [r for r in rows if r['id'] != row_id]
                 session['comparison_rows'] = rows
@@ -831,7 +1499,7 @@ def comparison_tool_page():
         # データを保存
         elif action == 'save_data':
             # フォームから列名を更新
-            for key, value in request.form.items():
+            for key, value in form.items():
                 if key.startswith('col_name_'):
                     col_id = int(key.replace('col_name_', ''))
                     for col in columns:
@@ -839,7 +1507,7 @@ def comparison_tool_page():
                             col['name'] = value.strip() if value.strip() else f'製品{col_id + 1}'
             
             # フォームから行名を更新
-            for key, value in request.form.items():
+            for key, value in form.items():
                 if key.startswith('row_name_'):
                     row_id = int(key.replace('row_name_', ''))
                     for row in rows:
@@ -847,7 +1515,7 @@ def comparison_tool_page():
                             row['label'] = value.strip() if value.strip() else '項目'
             
             # フォームからテキストデータを保存
-            for key, value in request.form.items():
+            for key, value in form.items():
                 if key.startswith('data_'):
                     parts = key.replace('data_', '').split('_')
                     if len(parts) == 2:
@@ -961,53 +1629,97 @@ def comparison_tool_page():
     return render_template('comparison_tool.html', **ctx)
 
 # ===== フォーラム（詰所） =====
+# 掲示板のページは記事・コメント・タグが変わったときにしか変わらないので、描画済み HTML を
+# 変更カウンタ（forum_version.counter）ごとにキャッシュし、HTML のハッシュを ETag にして 304 を返す
+def forum_content_version():
+    """掲示板の変更カウンタ。記事・コメント・タグが変わると必ず増える（1 行の主キー検索で求まる）"""
+    return get_db().execute("SELECT counter FROM forum_version WHERE id = 1").fetchone()[0]
+
+@functools.lru_cache(maxsize=128)
+def _cached_forum_page(render, args, version):
+    """(HTML, ETag) の組。ETag は HTML 自体のハッシュなので、テンプレートが変わっても一致しない"""
+    body = render(*args)
+    if body is None:
+        return None, None
+    return body, hashlib.md5(body.encode('utf-8')).hexdigest()
+
+def cached_forum_response(render, *args):
+    """render(*args) の HTML を掲示板の内容バージョンごとにキャッシュして返す（None は None のまま返す）
+
+    flash はユーザーごとのメッセージなので、表示待ちのものがあるときはキャッシュを使わない。
+    テンプレートの自動再読み込みが有効な間（開発時）も、編集がすぐ反映されるように使わない。
+    ブラウザには no-cache + ETag を返し、毎回の再検証で変わっていなければ 304 にする。
+    """
+    if session.get('_flashes') or app.jinja_env.auto_reload:
+        return render(*args)
+    body, etag = _cached_forum_page(render, args, forum_content_version())
+    if body is None:
+        return None
+    response = app.response_class(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route('/forum', methods=['GET'])
 def forum():
     tag = request.args.get('tag', '').strip().lower()
+    page = min(max(request.args.get('page', 1, type=int), 1), FORUM_MAX_PAGE)
+    return cached_forum_response(_render_forum, tag, page)
+
+def _render_forum(tag, page):
+    # 次ページの有無は 1 件多く読んで判定する（COUNT(*) で全件を数えない）
+    paging = (FORUM_PAGE_SIZE + 1, (page - 1) * FORUM_PAGE_SIZE)
     db = get_db()
     cur = db.cursor()
     if tag:
-        like = f'%{tag}%'
-        cur.execute("SELECT * FROM articles WHERE lower(tags) LIKE ? ORDER BY created_at DESC", (like,))
+        cur.execute(
+            "SELECT articles.* FROM article_tags JOIN articles ON articles.id = article_tags.article_id "
+            "WHERE article_tags.tag = ? ORDER BY articles.created_at DESC LIMIT ? OFFSET ?",
+            (tag, *paging),
+        )
     else:
-        cur.execute("SELECT * FROM articles ORDER BY created_at DESC")
+        cur.execute("SELECT * FROM articles ORDER BY created_at DESC LIMIT ? OFFSET ?", paging)
     articles = cur.fetchall()
-    
-    def get_tag_list(tags_str):
-        return [t.strip() for t in (tags_str or '').split(',') if t.strip()]
+    has_next = len(articles) > FORUM_PAGE_SIZE
+    articles = articles[:FORUM_PAGE_SIZE]
     
     ctx = {
         'page_title': '知恵袋・掲示板',
         'current_app': 'forum',
         'articles': articles,
         'tag': tag,
-        'get_tag_list': get_tag_list
+        'page': page,
+        'has_next': has_next
     }
     return render_template('forum.html', **ctx)
 
 @app.route('/post_article', methods=['POST'])
 @limiter.limit("5 per minute")
 def post_article_submit():
-    title = (request.form.get('title') or '').strip()
-    body = (request.form.get('body') or '').strip()
-    tags_raw = (request.form.get('tags') or '').strip()
+    form = request.form
+    title = (form.get('title') or '').strip()
+    body = (form.get('body') or '').strip()
+    tags_raw = (form.get('tags') or '').strip()
     
-    tags = [t.strip().lower() for t in tags_raw.split(',') if t.strip()]
+    tags = split_tags(tags_raw)
     if len(tags) > MAX_TAGS:
         flash(f'タグは最大 {MAX_TAGS} 個までです。', 'warning')
         return redirect(url_for('forum'))
     
-    for t in tags:
-        for w in FORBIDDEN_WORDS:
-            if w.lower() in t.lower():
-                flash('タグに不適切な語句が含まれています。', 'warning')
-                return redirect(url_for('forum'))
     tags_joined = ','.join(tags)
+    # カンマは単語の区切りになるので、連結後の文字列を 1 回走査すればタグごとの判定と同じになる
+    if contains_forbidden(tags_joined):
+        flash('タグに不適切な語句が含まれています。', 'warning')
+        return redirect(url_for('forum'))
     
     if not body:
         flash('本文は必須です。', 'warning')
         return redirect(url_for('forum'))
     
+    if contains_forbidden(title):
+        flash('タイトルに不適切な語句が含まれています。', 'warning')
+        return redirect(url_for('forum'))
+    
     is_spam, reason = check_spam_content(body, MAX_ARTICLE_LENGTH)
     if is_spam:
         flash(f'投稿を受け付けられません: {reason}', 'warning')
@@ -1015,44 +1727,51 @@ def post_article_submit():
     
     db = get_db()
     cur = db.cursor()
-    cur.execute("INSERT INTO articles (title, body, tags, created_at) VALUES (?, ?, ?, ?)",
-                (title, body, tags_joined, datetime.utcnow().isoformat()))
+    cur.execute(SQL_INSERT_ARTICLE, (title, body, tags_joined, datetime.utcnow().isoformat()))
+    article_id = cur.lastrowid
+    cur.executemany(SQL_INSERT_ARTICLE_TAG, [(article_id, t) for t in tags])
     db.commit()
     flash('記事を投稿しました（匿名）。', 'success')
     return redirect(url_for('forum'))
 
 @app.route('/article/<int:article_id>', methods=['GET'])
 def view_article(article_id):
+    response = cached_forum_response(_render_article, article_id)
+    if response is None:
+        flash('記事が見つかりません。', 'warning')
+        return redirect(url_for('forum'))
+    return response
+
+def _render_article(article_id):
+    """記事ページの HTML。記事がなければ None"""
     db = get_db()
     cur = db.cursor()
     cur.execute("SELECT * FROM articles WHERE id = ?", (article_id,))
     article = cur.fetchone()
     if not article:
-        flash('記事が見つかりません。', 'warning')
-        return redirect(url_for('forum'))
+        return None
     
     cur.execute("SELECT * FROM comments WHERE article_id = ? ORDER BY created_at ASC", (article_id,))
     comments = cur.fetchall()
     
     similar = []
-    if article['tags']:
-        tags = [t.strip() for t in article['tags'].split(',') if t.strip()]
-        if tags:
-            q_like = ' OR '.join(['lower(tags) LIKE ?' for _ in tags])
-            params = [f'%{t}%' for t in tags]
-            cur.execute(f"SELECT * FROM articles WHERE ({q_like}) AND id != ? ORDER BY created_at DESC LIMIT 6", (*params, article_id))
-            similar = cur.fetchall()
-    
-    def get_tag_list(tags_str):
-        return [t.strip() for t in (tags_str or '').split(',') if t.strip()]
+    if article.tags:
+        # この記事のタグと同じタグを持つ記事を article_tags の索引だけで探す
+        cur.execute(
+            "SELECT * FROM articles WHERE id IN ("
+            "SELECT other.article_id FROM article_tags AS mine "
+            "JOIN article_tags AS other ON other.tag = mine.tag WHERE mine.article_id = ?"
+            ") AND id != ? ORDER BY created_at DESC LIMIT 6",
+            (article_id, article_id),
+        )
+        similar = cur.fetchall()
     
     ctx = {
-        'page_title': article['title'] or '記事',
+        'page_title': article.title or '記事',
         'current_app': 'forum',
         'article': article,
         'comments': comments,
-        'similar': similar,
-        'get_tag_list': get_tag_list
+        'similar': similar
     }
     return render_template('article.html', **ctx)
 
@@ -1071,12 +1790,21 @@ def post_comment_submit(article_id):
     
     db = get_db()
     cur = db.cursor()
-    cur.execute("INSERT INTO comments (article_id, body, created_at) VALUES (?, ?, ?)",
-                (article_id, body, datetime.utcnow().isoformat()))
+    cur.execute(SQL_INSERT_COMMENT, (article_id, body, datetime.utcnow().isoformat()))
     db.commit()
     flash('コメントを投稿しました（匿名）。', 'success')
     return redirect(url_for('view_article', article_id=article_id))
 
+# ===== ヘルスチェック =====
+# 死活監視から高頻度で呼ばれるため、本文は起動時にエンコード済みのものを使う
+# Response 自体は共有しない（永続セッションの Set-Cookie が後から付与されるため）
+_HEALTH_BODY = b'{"status":"healthy"}'
+
+@app.route('/health')
+@limiter.exempt
+def health():
+    return app.response_class(_HEALTH_BODY, mimetype='application/json')
+
 @app.route('/_routes_debug')
 def _routes_debug():
     out = []
@@ -1085,4 +1813,9 @@ def _routes_debug():
     return "<br>".join(sorted(out))
 
 if __name__ == '__main__':
-    app.run(debug=True, host='127.0.0.1', port=5000)
+    # 開発用サーバー。デバッガとリローダーは FLASK_DEBUG=1 のときだけ有効にする
+    app.run(
+        debug=os.environ.get('FLASK_DEBUG') == '1',
+        host=os.environ.get('FLASK_RUN_HOST', '127.0.0.1'),
+        port=int(os.environ.get('PORT', 5000)),
+    )
@@ -0,0 +1,17 @@
+# 本番用 WSGI エントリポイント
+# 起動: gunicorn -c gunicorn.conf.py wsgi:application
+# app を読み込む前に標準ライブラリを gevent 化し、ソケットの読み書き（アップロードの受信、
+# 応答の送信、keep-alive の待ち）の間は同じワーカーで他のリクエストを処理できるようにする。
+# sqlite3 のファイル I/O・ロック待ちは C 拡張の中で行われるので gevent には切り替わらず、
+# DXF・Excel の生成などの CPU 処理とあわせて、その間はワーカー全体が止まる。
+# HEIC のデコード・エンコードは heic_executor() が gevent のネイティブスレッドプールで
+# 走らせるのでワーカーを止めない。重い処理の並列度はワーカー数で確保する
+try:
+    from gevent import monkey
+    monkey.patch_all()
+except ImportError:
+    pass
+
+from app import app
+
+application = app